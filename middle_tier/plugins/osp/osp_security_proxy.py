@@ -1,7 +1,13 @@
+import hashlib
 import json
 import logging
+import threading
+import time
+from concurrent.futures import Future
 
+import cachetools
 import requests
+from requests.adapters import HTTPAdapter
 
 from exceptions import MiddleTierException
 from proxy.response import Response
@@ -16,6 +22,7 @@ USERNAME_PROP = "username"
 PASSWORD_PROP = "password"
 APP_PROP = "app"
 TIMEOUT = "timeout"
+CACHE_TTL = "cache_ttl"
 
 
 class OSPAuthenticationResponse(AuthenticationResponse):
@@ -28,19 +35,90 @@ class OSPAuthenticationResponse(AuthenticationResponse):
         return self.response.get("username")
 
 
+class BearerToken:
+    """
+    A bearer token paired with its SHA-256 digest.  The digest is what the token
+    caches key on, and wrapping the token once per request keeps the security proxy
+    and the virtual endpoints from hashing the same bytes over and over.
+    """
+    __slots__ = ("raw", "digest")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.digest = hashlib.sha256(raw.encode("utf-8")).digest()
+
+
+_BEARER = "Bearer "
+
+
+def _strip_bearer(header):
+    """
+    Strip the Bearer prefix from an Authorization header and wrap what's left in a
+    BearerToken.  Raises UnauthorizedSecurityException when the header is missing
+    or doesn't carry a bearer token.
+    """
+    if not header or not header.startswith(_BEARER):
+        raise UnauthorizedSecurityException("Not authorized")
+    return BearerToken(header[7:])
+
+
 class OSPTokenCheckClient:
     """
     This class handles calling the OSP server to validate tokens.  It manages the introspect URL 
     and makes the REST request to check if a token is valid.
     """
-    def __init__(self, url, username, password, app, timeout=10):
+    def __init__(self, url, username, password, app, timeout=10, cache_ttl=60):
         self.app = app
         self.token_url = self.get_osp_introspect_url(url, app)
         self.attr_url = self.get_osp_attributes_url(url, app)
         self.username = username
         self.timeout = timeout
         self.password = password
-        
+
+        '''
+        We keep a single session for all of the calls to OSP.  The session holds a pool
+        of keep-alive connections so repeated token checks reuse the same socket instead
+        of paying for a new TCP and TLS handshake on every request.
+        '''
+        self._session = requests.Session()
+        self._session.auth = (username, password)
+        self._session.headers["Accept"] = "application/json"
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50, max_retries=0)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        '''
+        The same bearer token shows up on many requests in a row, so we remember the
+        OSP answers for a short window instead of calling OSP every time.  The caches
+        are keyed by a SHA-256 digest of the token so we never hold plaintext tokens
+        in memory.  Entries also respect the expiration field OSP returns, so a token
+        that expires sooner than the cache TTL is never served stale.
+
+        TTLCache is not thread safe, so every read and write goes through the
+        cache lock.  The critical sections are tiny dictionary operations, never
+        the HTTP calls themselves.
+        '''
+        self.cache_ttl = cache_ttl
+        self._cache_lock = threading.Lock()
+        self._token_cache = cachetools.TTLCache(maxsize=10000, ttl=cache_ttl)
+        self._attr_cache = cachetools.TTLCache(maxsize=10000, ttl=cache_ttl)
+
+        '''
+        Tokens that OSP already told us are inactive get remembered for a short
+        window too.  After a token rotation every client retries with the same stale
+        token, and without this cache each of those retries would hit OSP.  The TTL
+        is kept short so a revoked token never stays rejected for long.
+        '''
+        self._negative_cache = cachetools.TTLCache(maxsize=10000, ttl=min(30, cache_ttl))
+
+        '''
+        When several concurrent requests carry the same token and all miss the
+        cache, only the first one should actually call OSP.  The in-flight map
+        holds a Future per outstanding call that the other threads wait on.
+        '''
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
         if url is None:
             raise MiddleTierException("The target_url parameter is not configured in the services.json file.")
         if username is None:
@@ -54,68 +132,222 @@ class OSPTokenCheckClient:
         """Get the OSP introspect REST endpoint URL"""
         url = '{base}/osp/a/{app}/auth/oauth2/introspect'.format(base=url,
                                                                  app=app)
-        logger.debug("OSP introspect url = {}".format(url))
+        logger.debug("OSP introspect url = %s", url)
         return url
-        
+
     def get_osp_attributes_url(self, url, app):
         """Get the OSP attributes REST endpoint URL"""
-        url = '{base}/osp/a/{app}/auth/oauth2/getattributes?attributes=client+name+last_name+first_name+initials+email+roles+language+cacheable+expiration&access_token='.format(base=url,
+        url = '{base}/osp/a/{app}/auth/oauth2/getattributes?attributes=client+name+last_name+first_name+initials+email+roles+language+cacheable+expiration'.format(base=url,
                                                                  app=app)
-        logger.debug("OSP introspect url = {}".format(url))
+        logger.debug("OSP attributes url = %s", url)
         return url
 
+    def _cache_get(self, cache, key):
+        """
+        Get a cached OSP response if it is still usable.  A cached entry is dropped
+        once the expiration time reported by OSP has passed, even if the cache TTL
+        hasn't elapsed yet.
+        """
+        with self._cache_lock:
+            response = cache.get(key)
+            if response is None:
+                return None
+            expiration = response.get("expiration")
+            if isinstance(expiration, (int, float)) and expiration <= time.time():
+                cache.pop(key, None)
+                return None
+            return response
+
+    def _single_flight(self, key, fetch):
+        """
+        Make sure only one thread runs the OSP call for a given token at a time.
+        The first caller creates a Future, runs the call, and publishes the result
+        or the exception.  Concurrent callers with the same key just wait on that
+        Future instead of issuing a duplicate request.
+        """
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                owner = False
+            else:
+                future = Future()
+                self._inflight[key] = future
+                owner = True
+        if not owner:
+            return future.result()
+        try:
+            result = fetch()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+
     def check_token(self, token):
         """
         This function makes the REST call to validate the token.  It will return the JSON
         response from OSP which may be token information or may indicate that the token is
         not active.
         """
-        logger.debug("OSP token url: {}".format(self.token_url))
+        logger.debug("OSP token url: %s", self.token_url)
+        if not isinstance(token, BearerToken):
+            token = BearerToken(token)
+        key = token.digest
+        with self._cache_lock:
+            rejected = key in self._negative_cache
+        if rejected:
+            logger.debug("Rejecting token from the negative cache")
+            raise UnauthorizedSecurityException("Not authorized")
+        response = self._cache_get(self._token_cache, key)
+        if response is not None:
+            logger.debug("Using cached OSP token response")
+            return response
+        return self._single_flight(("introspect", key), lambda: self._fetch_token(token, key))
+
+    def _fetch_token(self, token, key):
+        """Make the introspect HTTP call and cache the outcome"""
         try:
-            r = requests.post(self.token_url, auth=(self.username, self.password), data={
-                "token": token}, timeout=self.timeout)
-            logger.debug("OSP returns: {}".format(r.text))
-            logger.debug("r.status_code: {}".format(r.status_code))
+            r = self._session.post(self.token_url, data={
+                "token": token.raw}, timeout=self.timeout)
+            '''
+            Accessing r.text decodes the whole body, so we only touch it when debug
+            logging is actually turned on.
+            '''
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("OSP returns: %s", r.text)
+                logger.debug("r.status_code: %s", r.status_code)
             if r.status_code == 200:
-                return r.json()
+                response = r.json()
+                '''
+                We only cache active tokens.  Inactive responses stay uncached so a
+                token that gets refreshed is picked up right away.
+                '''
+                with self._cache_lock:
+                    if response.get("active"):
+                        self._token_cache[key] = response
+                    else:
+                        self._negative_cache[key] = True
+                return response
             elif r.status_code == 401:
                 '''
                 When the server returns a 401 it means that the client ID or 
                 client secret are incorrect.  In this case we can give a better
                 error message to help sort out the configuration issue.
                 '''
+                with self._cache_lock:
+                    self._token_cache.pop(key, None)
                 raise IncorrectSecurityConfigurationException("Unable to authenticate request")
             else:
+                '''
+                Other statuses are transient server problems, not a verdict on the
+                token, so they must not go into the negative cache.  Caching them
+                would turn an OSP outage into 401s and restart the browser token
+                refresh loop described in the endpoint handlers below.
+                '''
                 return None
-        except Exception as e:
-            logger.exception("Failed to run OSP token checker")
-            raise e
-            
+        except Exception:
+            '''
+            The callers re-raise with context, so a warning is enough here.  We only
+            pay for traceback formatting when debug logging is turned on.
+            '''
+            logger.warning("OSP call failed", exc_info=logger.isEnabledFor(logging.DEBUG))
+            raise
+
     def check_attributes(self, token):
         """
         This function makes the REST call to get attributes based on the user represented
         by the token.  It will return the JSON response from OSP which may be a JSON 
         document with user information or may indicate that the token is not active.
         """
-        logger.debug("OSP attributes url: {}".format(self.attr_url + token))
+        logger.debug("OSP attributes url: %s", self.attr_url)
+        if not isinstance(token, BearerToken):
+            token = BearerToken(token)
+        key = token.digest
+        with self._cache_lock:
+            rejected = key in self._negative_cache
+        if rejected:
+            logger.debug("Rejecting token from the negative cache")
+            raise UnauthorizedSecurityException("Not authorized")
+        response = self._cache_get(self._attr_cache, key)
+        if response is not None:
+            logger.debug("Using cached OSP attributes response")
+            return response
+        return self._single_flight(("attributes", key), lambda: self._fetch_attributes(token, key))
+
+    def _fetch_attributes(self, token, key):
+        """Make the getattributes HTTP call and cache the outcome"""
         try:
-            r = requests.get(self.attr_url + token, auth=(self.username, self.password), timeout=self.timeout)
-            logger.debug("OSP returns: {}".format(r.text))
-            logger.debug("r.status_code: {}".format(r.status_code))
+            r = self._session.get(self.attr_url, params={"access_token": token.raw}, timeout=self.timeout)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("OSP returns: %s", r.text)
+                logger.debug("r.status_code: %s", r.status_code)
             if r.status_code == 200:
-                return r.json()
+                response = r.json()
+                with self._cache_lock:
+                    if not response.get("error"):
+                        self._attr_cache[key] = response
+                    else:
+                        self._negative_cache[key] = True
+                return response
             elif r.status_code == 401:
                 '''
                 When the server returns a 401 it means that the client ID or 
                 client secret are incorrect.  In this case we can give a better
                 error message to help sort out the configuration issue.
                 '''
+                with self._cache_lock:
+                    self._attr_cache.pop(key, None)
                 raise IncorrectSecurityConfigurationException("Unable to authenticate request")
             else:
+                '''
+                Other statuses are transient server problems, not a verdict on the
+                token, so they must not go into the negative cache.
+                '''
                 return None
-        except Exception as e:
-            logger.exception("Failed to run OSP token checker")
-            raise e
+        except Exception:
+            '''
+            The callers re-raise with context, so a warning is enough here.  We only
+            pay for traceback formatting when debug logging is turned on.
+            '''
+            logger.warning("OSP call failed", exc_info=logger.isEnabledFor(logging.DEBUG))
+            raise
+
+    def check_all(self, token):
+        """
+        Validate a token and get its user attributes with a single OSP call.  The
+        getattributes endpoint reports an error for inactive tokens, so one call
+        gives us both the attributes and the active status without the separate
+        introspect round trip.
+        """
+        response = self.check_attributes(token)
+        if response is None:
+            return None
+        result = dict(response)
+        result["active"] = not response.get("error")
+        return result
+
+
+_client_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_client(url, username, password, app, timeout=10, cache_ttl=60):
+    """
+    Get the shared OSPTokenCheckClient for an OSP server and client ID.  The
+    security proxy and the virtual endpoints normally point at the same OSP
+    configuration, and handing them the same client means they also share its
+    connection pool and token caches instead of each keeping their own.
+    """
+    key = (url, username, app)
+    with _registry_lock:
+        client = _client_registry.get(key)
+        if client is None:
+            client = OSPTokenCheckClient(url, username, password, app, timeout, cache_ttl)
+            _client_registry[key] = client
+        return client
 
 
 class OSPProxy(CustomKeyHandler):
@@ -135,18 +367,16 @@ class OSPProxy(CustomKeyHandler):
         password = data.get(PASSWORD_PROP)
         app = data.get(APP_PROP)
         timeout = data.get(TIMEOUT, 10)
-        self.osp_client = OSPTokenCheckClient(url, username, password, app, timeout)
+        cache_ttl = data.get(CACHE_TTL, 60)
+        self.osp_client = get_client(url, username, password, app, timeout, cache_ttl)
 
     def check(self, token):
-        logger.debug("OSP security proxy data = {}".format(self.config))
-        bearer_prefix = "Bearer "
-        if not token.startswith(bearer_prefix):
-            raise UnauthorizedSecurityException("Not authorized")
-        token = token[len(bearer_prefix):]
+        logger.debug("OSP security proxy data = %s", self.config)
+        token = _strip_bearer(token)
         try:
             check_token = self.osp_client.check_token(token)
             is_active = check_token.get('active', False)
-            logger.debug("OSP user status: {}".format(is_active))
+            logger.debug("OSP user status: %s", is_active)
             if is_active:
                 return OSPAuthenticationResponse(check_token)
             else:
@@ -172,19 +402,16 @@ class OSPVirtualEndpoint(Resource):
         password = data.get(PASSWORD_PROP)
         app = data.get(APP_PROP)
         timeout = data.get(TIMEOUT, 10)
-        self.osp_client = OSPTokenCheckClient(url, username, password, app, timeout)
+        cache_ttl = data.get(CACHE_TTL, 60)
+        self.osp_client = get_client(url, username, password, app, timeout, cache_ttl)
         
     def get_attributes(self, request):
-        bearer_prefix = "Bearer "
-        token = request.headers.get("Authorization")
-        if not token or not token.startswith(bearer_prefix):
-            raise UnauthorizedSecurityException("Not authorized")
-        token = token[len(bearer_prefix):]
-        
+        token = _strip_bearer(request.headers.get("Authorization"))
+
         try:
-            response = self.osp_client.check_attributes(token)
+            response = self.osp_client.check_all(token)
             is_error = response.get('error')
-            logger.debug("OSP user attributes status: {}".format(is_error))
+            logger.debug("OSP user attributes status: %s", is_error)
             if is_error:
                 raise UnauthorizedSecurityException("Not authorized")
         except UnauthorizedSecurityException:
@@ -223,15 +450,11 @@ means your OSP server was either offline or unreachable.
         return Response(json.dumps(response), headers={'Content-type': "application/json"})
 
     def get_token(self, request):
-        bearer_prefix = "Bearer "
-        token = request.headers.get("Authorization")
-        if not token or not token.startswith(bearer_prefix):
-            raise UnauthorizedSecurityException("Not authorized")
-        token = token[len(bearer_prefix):]
+        token = _strip_bearer(request.headers.get("Authorization"))
         try:
-            response = self.osp_client.check_token(token)
+            response = self.osp_client.check_all(token)
             is_active = response.get('active', False)
-            logger.debug("OSP user status: {}".format(is_active))
+            logger.debug("OSP user status: %s", is_active)
             if not is_active:
                 raise UnauthorizedSecurityException("Not authorized")
         except UnauthorizedSecurityException:
@@ -0,0 +1,118 @@
+import json
+import threading
+import time
+import unittest
+
+from plugins.osp.osp_security_proxy import BearerToken, OSPTokenCheckClient
+from security import UnauthorizedSecurityException
+
+
+class StubResponse:
+    """A canned HTTP response standing in for what the OSP server returns"""
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = json.dumps(body)
+
+    def json(self):
+        return self.body
+
+
+class StubSession:
+    """
+    Stands in for the client's requests session so the tests never touch the
+    network.  It counts how many calls actually reach "OSP" and can delay each
+    call to simulate a slow server for the coalescing test.
+    """
+    def __init__(self, response, delay=0):
+        self.response = response
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _respond(self):
+        with self._lock:
+            self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        return self.response
+
+    def post(self, url, data=None, timeout=None):
+        return self._respond()
+
+    def get(self, url, params=None, timeout=None):
+        return self._respond()
+
+
+def make_client(response, delay=0):
+    client = OSPTokenCheckClient("http://osp", "client", "secret", "app")
+    client._session = StubSession(response, delay)
+    return client
+
+
+class TestOSPTokenCheckClient(unittest.TestCase):
+    def test_cache_hit_skips_http(self):
+        client = make_client(StubResponse(200, {"active": True, "username": "admin"}))
+        first = client.check_token("token1")
+        second = client.check_token("token1")
+        self.assertEqual(first, second)
+        self.assertEqual(client._session.calls, 1)
+
+    def test_inactive_token_hits_negative_cache(self):
+        client = make_client(StubResponse(200, {"active": False}))
+        response = client.check_token("token1")
+        self.assertFalse(response.get("active"))
+        with self.assertRaises(UnauthorizedSecurityException):
+            client.check_token("token1")
+        self.assertEqual(client._session.calls, 1)
+
+    def test_transient_error_is_not_negative_cached(self):
+        client = make_client(StubResponse(502, {}))
+        self.assertIsNone(client.check_token("token1"))
+        self.assertIsNone(client.check_token("token1"))
+        self.assertEqual(client._session.calls, 2)
+
+    def test_cached_entry_expires_with_osp_expiration(self):
+        expired = {"active": True, "expiration": time.time() - 5}
+        client = make_client(StubResponse(200, expired))
+        client.check_token("token1")
+        client.check_token("token1")
+        self.assertEqual(client._session.calls, 2)
+
+    def test_concurrent_misses_make_one_call(self):
+        client = make_client(StubResponse(200, {"active": True}), delay=0.2)
+        results = []
+
+        def check():
+            results.append(client.check_token("token1"))
+
+        threads = [threading.Thread(target=check) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 5)
+        for result in results:
+            self.assertTrue(result.get("active"))
+        self.assertEqual(client._session.calls, 1)
+
+    def test_check_all_derives_active_status(self):
+        client = make_client(StubResponse(200, {"username": "admin"}))
+        response = client.check_all("token1")
+        self.assertTrue(response.get("active"))
+        self.assertEqual(response.get("username"), "admin")
+
+        client = make_client(StubResponse(200, {"error": "invalid_token"}))
+        response = client.check_all("token2")
+        self.assertFalse(response.get("active"))
+
+    def test_bearer_token_accepted_directly(self):
+        client = make_client(StubResponse(200, {"active": True}))
+        token = BearerToken("token1")
+        client.check_token(token)
+        client.check_token("token1")
+        self.assertEqual(client._session.calls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()